@@ -13,23 +13,25 @@ Outputs:
 
 import os
 import zipfile
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import requests
 
-# FRED data
-from pandas_datareader import data as pdr
-
-# pytrends
-from pytrends.request import TrendReq
-import time
+from market_watch_common import (
+    FRED_CACHE_MAX_AGE, PNG_PIL_KWARGS, TRENDS_CACHE_MAX_AGE, add_line_collection,
+    fetch_fred_csv, fetch_interest, fred_cache_path, monthly, pyplot, pytrends_client, read_cache,
+    trends_cache_path, write_cache,
+)
 
 # ----------------------------
 # Settings (必要ならここを編集)
 # ----------------------------
 # timeframe: last 12 months to give margin (workflow earlier used 6 months; adjust if you want)
-END = pd.Timestamp.today()
+END = pd.Timestamp.today().normalize()
 START = END - pd.DateOffset(months=12)
+# Google Trends window (pytrends timeframe string)
+TRENDS_TIMEFRAME = "today 6-m"
 
 # FRED series
 FRED_SERIES = {
@@ -48,11 +50,7 @@ KEYWORDS = [
 ]
 
 # pytrends user-agent / requests args: GitHub Actions 実行では標準 User-Agent を指定しておくと安定
-REQUESTS_ARGS = {
-    'headers': {
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0 Safari/537.36'
-    }
-}
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0 Safari/537.36'
 
 # Output filenames
 MACRO_PNG = "macro_graph.png"
@@ -63,20 +61,45 @@ TRENDS_CSV = "trends_data.csv"
 # ----------------------------
 # Fetch macro from FRED
 # ----------------------------
+def fast_concat_axis1(frames):
+    """Column-wise concat: align every frame on the union index once, then stack the values."""
+    idx = frames[0].index
+    for f in frames[1:]:
+        idx = idx.union(f.index)
+    arrs = [f.reindex(idx).to_numpy() for f in frames]
+    cols = [c for f in frames for c in f.columns]
+    # np.hstack already allocated a fresh block; let the DataFrame wrap it without copying
+    return pd.DataFrame(np.hstack(arrs), index=idx, columns=cols, copy=False)
+
+def fetch_fred_series(code, start=START, end=END, session=None):
+    path = fred_cache_path(code, start, end)
+    cached = read_cache(path, max_age=FRED_CACHE_MAX_AGE)
+    if cached is not None:
+        return cached
+    s = fetch_fred_csv(code, start, end, session)
+    write_cache(s, path)
+    return s
+
 def fetch_macro(start=START, end=END):
-    dfm = pd.DataFrame(index=pd.date_range(start=start, end=end, freq='D'))
     series_data = {}
-    for name, code in FRED_SERIES.items():
-        try:
-            s = pdr.DataReader(code, "fred", start, end)
-            s = s.rename(columns={s.columns[0]: name})
-            series_data[name] = s
-        except Exception as e:
-            print(f"⚠️ Failed to fetch {code}: {e}")
-    # combine monthly (resample to month-end mean)
+    # FRED requests are independent and network-bound -> fetch them concurrently.
+    # One Session, built here before any job starts, holds the connection pool for the run
+    # (the concurrent GETs each use their own pooled connection).
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=len(FRED_SERIES)) as pool:
+        futures = {name: pool.submit(fetch_fred_series, code, start, end, session)
+                   for name, code in FRED_SERIES.items()}
+        for name, fut in futures.items():
+            try:
+                series_data[name] = fut.result()
+            except Exception as e:
+                print(f"⚠️ Failed to fetch {FRED_SERIES[name]}: {e}")
+    # combine monthly (month-end mean)
     if not series_data:
         return pd.DataFrame()
-    combined = pd.concat([series_data[k].resample('M').mean() for k in series_data], axis=1)
+    # one frame of raw observations (one column per series), aggregated in a single pass
+    raw = fast_concat_axis1(list(series_data.values()))
+    raw.columns = list(series_data)
+    combined = monthly(raw, "mean")
     # compute M2 YoY (%) if present
     if "M2" in combined.columns:
         combined["M2_YoY_pct"] = combined["M2"].pct_change(12) * 100
@@ -85,12 +108,23 @@ def fetch_macro(start=START, end=END):
     combined = combined.drop(columns=[c for c in combined.columns if c in ("M2",)])
     return combined
 
+# ----------------------------
+# Plot helpers
+# ----------------------------
+def _reset_figure(fig=None):
+    """Return an empty 12x5 figure, clearing ``fig`` for reuse when one is given."""
+    plt = pyplot()
+    if fig is None:
+        return plt.figure(figsize=(12,5))
+    fig.clf()
+    return fig
+
 # ----------------------------
 # Plot macro
 # Left axis: M2_YoY_pct, HY
 # Right axis: VIX
 # ----------------------------
-def plot_macro(df):
+def plot_macro(df, fig=None):
     if df.empty:
         print("⚠️ macro df is empty — skipping macro plot")
         return False
@@ -102,61 +136,69 @@ def plot_macro(df):
         left_cols.append("HY")
     right_col = "VIX" if "VIX" in df.columns else None
 
-    fig, ax1 = plt.subplots(figsize=(12,5))
+    own_fig = fig is None
+    fig = _reset_figure(fig)
+    ax1 = fig.subplots()
     for col in left_cols:
-        ax1.plot(df.index, df[col], label=col)
+        ax1.plot(df.index, df[col], label=col, rasterized=True)
     ax1.set_xlabel("Date")
     ax1.set_ylabel("Left axis: M2 YoY (%) / HY Spread (bps or %)")
     ax1.legend(loc='upper left')
 
     if right_col:
         ax2 = ax1.twinx()
-        ax2.plot(df.index, df[right_col], color='tab:orange', linestyle='--', label=right_col)
+        ax2.plot(df.index, df[right_col], color='tab:orange', linestyle='--', label=right_col, rasterized=True)
         ax2.set_ylabel(f"{right_col} (index)")
         ax2.legend(loc='upper right')
 
     ax1.grid(True)
-    plt.title("M2 YoY, HY Spread, VIX")
-    plt.tight_layout()
-    plt.savefig(MACRO_PNG)
-    plt.close()
+    ax1.set_title("M2 YoY, HY Spread, VIX")
+    fig.tight_layout()
+    fig.savefig(MACRO_PNG, pil_kwargs=PNG_PIL_KWARGS)
+    if own_fig:
+        plt = pyplot()
+        plt.close(fig)
     print(f"✅ Saved macro plot {MACRO_PNG}")
     return True
 
 # ----------------------------
 # Fetch Google Trends (pytrends)
 # ----------------------------
-def fetch_trends(keywords, timeframe="today 6-m"):
-    pytrends = TrendReq(hl='en-US', tz=360, requests_args=REQUESTS_ARGS)
+def fetch_trends(keywords, timeframe=TRENDS_TIMEFRAME):
+    path = trends_cache_path(keywords, timeframe)
+    cached = read_cache(path, max_age=TRENDS_CACHE_MAX_AGE)
+    if cached is not None:
+        return cached
     try:
-        pytrends.build_payload(keywords, timeframe=timeframe)
-        df = pytrends.interest_over_time()
+        df = fetch_interest(pytrends_client(USER_AGENT), keywords, timeframe)
         if df.empty:
             print("⚠️ No trends data returned (empty).")
-            return pd.DataFrame()
-        # drop isPartial column if present
-        df = df.loc[:, [c for c in df.columns if c != 'isPartial']]
-        return df
+            return df
     except Exception as e:
         print(f"⚠️ pytrends error: {e}")
         return pd.DataFrame()
+    write_cache(df, path)
+    return df
 
-def plot_trends(df, keywords):
+def plot_trends(df, keywords, fig=None):
     if df.empty:
         print("⚠️ trends df empty — skipping trends plot")
         return False
-    fig, ax = plt.subplots(figsize=(12,5))
-    for kw in keywords:
-        if kw in df.columns:
-            ax.plot(df.index, df[kw], label=kw)
+    own_fig = fig is None
+    fig = _reset_figure(fig)
+    ax = fig.subplots()
+    present = df.columns.intersection(keywords, sort=False).tolist()
+    handles = add_line_collection(ax, df.index, df[present].to_numpy())
     ax.set_xlabel("Date")
     ax.set_ylabel("Interest (0-100)")
-    ax.legend(loc='upper left')
+    ax.legend(handles, present, loc='upper left')
     ax.grid(True)
-    plt.title("Google Trends (daily) - specified keywords")
-    plt.tight_layout()
-    plt.savefig(TRENDS_PNG)
-    plt.close()
+    ax.set_title("Google Trends (daily) - specified keywords")
+    fig.tight_layout()
+    fig.savefig(TRENDS_PNG, pil_kwargs=PNG_PIL_KWARGS)
+    if own_fig:
+        plt = pyplot()
+        plt.close(fig)
     print(f"✅ Saved trends plot {TRENDS_PNG}")
     return True
 
@@ -166,23 +208,39 @@ def plot_trends(df, keywords):
 def main():
     # create output dir if necessary
     try:
+        # Google Trends runs in the background while FRED is fetched / plotted
+        trends_pool = ThreadPoolExecutor(max_workers=1)
+        print("Fetching Google Trends...")
+        trends_future = trends_pool.submit(fetch_trends, KEYWORDS, timeframe=TRENDS_TIMEFRAME)
+        trends_pool.shutdown(wait=False)
+
+        # one Figure is shared by both plots (created on first use, cleared between them)
+        fig = None
+
         print("Fetching macro data from FRED...")
         macro = fetch_macro()
         if not macro.empty:
-            macro.to_csv(MACRO_CSV)
+            macro.to_csv(MACRO_CSV, lineterminator="\n")
             print(f"✅ Saved {MACRO_CSV}")
-            plot_macro(macro)
+            if fig is None:
+                fig = _reset_figure()
+            plot_macro(macro, fig)
         else:
             print("⚠️ Macro data empty; no macro CSV/plot created.")
 
-        print("Fetching Google Trends...")
-        trends = fetch_trends(KEYWORDS, timeframe="today 6-m")
+        trends = trends_future.result()
         if not trends.empty:
-            trends.to_csv(TRENDS_CSV)
+            trends.to_csv(TRENDS_CSV, float_format="%g", lineterminator="\n")
             print(f"✅ Saved {TRENDS_CSV}")
-            plot_trends(trends, KEYWORDS)
+            if fig is None:
+                fig = _reset_figure()
+            plot_trends(trends, KEYWORDS, fig)
         else:
             print("⚠️ Trends data empty; no trends CSV/plot created.")
+        if fig is not None:
+            plt = pyplot()
+            # release every figure buffer before zipping / interpreter teardown
+            plt.close("all")
 
         # create zip of available files (in case workflow step wants zip)
         files_to_zip = [f for f in [MACRO_PNG, MACRO_CSV, TRENDS_PNG, TRENDS_CSV] if os.path.exists(f)]
@@ -190,7 +248,8 @@ def main():
             zname = "market_watch_results.zip"
             with zipfile.ZipFile(zname, "w", zipfile.ZIP_DEFLATED) as z:
                 for f in files_to_zip:
-                    z.write(f)
+                    # PNG is already deflate-compressed; store it instead of re-compressing
+                    z.write(f, compress_type=zipfile.ZIP_STORED if f.endswith(".png") else None)
             print(f"✅ Created zip {zname} with {len(files_to_zip)} files.")
         else:
             print("⚠️ No files to zip.")
@@ -0,0 +1,175 @@
+# market_watch_common.py
+# Helpers shared by market_watch_auto.py, market_watch_macro.py and market_watch_trends.py:
+# disk cache, FRED download, retry policy, month-end aggregation and plotting setup.
+
+import hashlib
+import io
+import os
+import random
+import tempfile
+import time
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import requests
+
+# FRED series (fetched directly from the fredgraph CSV endpoint)
+FRED_CSV_URL = "https://fred.stlouisfed.org/graph/fredgraph.csv"
+FRED_TIMEOUT = (5, 20)  # (connect, read) seconds: a stalled connection fails instead of hanging
+
+# On-disk cache for FRED / pytrends responses (re-runs skip the network)
+# (set MW_FORCE_REFRESH=1 to always re-download)
+CACHE_DIR = ".cache"
+FRED_CACHE_MAX_AGE = 12 * 3600  # seconds; past FRED observations don't change
+TRENDS_CACHE_MAX_AGE = 6 * 3600  # seconds; avoids re-hitting Google's rate limit
+
+# Google Trends (pytrends)
+TRENDS_TIMEOUT = (10, 25)  # (connect, read) seconds for every pytrends request
+
+# PNG encoder options for every saved figure: fast zlib level, since the images are CI
+# artifacts and encode time matters more than a few KB
+PNG_PIL_KWARGS = {"compress_level": 1}
+
+# ----------------------------
+# Disk cache
+# ----------------------------
+def fred_cache_path(series_id, start, end, cache_dir=os.path.join(CACHE_DIR, "fred")):
+    """Cache file for one series over one date window (a different window is a different file)."""
+    return os.path.join(cache_dir, f"{series_id}_{start:%Y%m%d}_{end:%Y%m%d}.parquet")
+
+def trends_cache_path(keywords, timeframe):
+    key = (tuple(sorted(keywords)), timeframe)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "pytrends", f"{digest}.parquet")
+
+def read_cache(path, max_age=None):
+    """Cached frame at ``path``, or None if missing, older than ``max_age`` seconds or unreadable."""
+    if os.environ.get("MW_FORCE_REFRESH") == "1" or not os.path.exists(path):
+        return None
+    if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception as e:  # corrupt / truncated file, missing Parquet engine, ...
+        print(f"⚠️ ignoring unreadable cache {path}: {e}", flush=True)
+        return None
+
+def write_cache(df, path):
+    """Best-effort atomic write; returns False (with a warning) if the cache is unwritable.
+
+    The frame goes to a temp file in the same directory and is then renamed over ``path``,
+    so a killed run or two scripts writing the same entry never leave a partial file behind.
+    """
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+    except Exception as e:  # read-only dir, missing Parquet engine, ...
+        print(f"⚠️ could not write cache {path}: {e}", flush=True)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+# ----------------------------
+# Network
+# ----------------------------
+def backoff(attempt, base=1.0, cap=30.0):
+    """Full-jitter exponential back-off: uniform in [0, min(cap, base * 2**attempt)] seconds."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def is_transient(exc):
+    """True for errors worth retrying: 429 / 5xx responses, connection failures, timeouts.
+
+    Works for requests.HTTPError and pytrends' ResponseError alike (both carry ``.response``).
+    """
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+def fetch_fred_csv(series_id, start, end, session=None):
+    """One fredgraph.csv GET parsed into a float64 frame indexed by DATE, column ``series_id``.
+
+    ``session`` is an optional requests.Session owned by the caller (plain requests.get otherwise).
+    """
+    session = session or requests
+    params = {"id": series_id, "cosd": f"{start:%Y-%m-%d}", "coed": f"{end:%Y-%m-%d}"}
+    r = session.get(FRED_CSV_URL, params=params, timeout=FRED_TIMEOUT)
+    r.raise_for_status()
+    # FRED marks missing observations with "."
+    df = pd.read_csv(io.StringIO(r.text), index_col=0, parse_dates=True, na_values=".")
+    df.index.name = "DATE"
+    df.columns = [series_id]
+    # stays float64: the published CSVs print these values, float32 would show rounding noise
+    return df
+
+@lru_cache(maxsize=None)
+def pytrends_client(user_agent):
+    """TrendReq sending ``user_agent``, built once per agent (its constructor fetches Google cookies)."""
+    from pytrends.request import TrendReq
+    requests_args = {"headers": {"User-Agent": user_agent}, "verify": True}
+    return TrendReq(hl="en-US", tz=360, timeout=TRENDS_TIMEOUT, requests_args=requests_args)
+
+def fetch_interest(client, keywords, timeframe):
+    """interest_over_time() for ``keywords`` without the isPartial flag; empty frame if no data."""
+    client.build_payload(keywords, timeframe=timeframe)
+    df = client.interest_over_time()
+    if df is None or df.empty:
+        return pd.DataFrame()
+    df = df.drop(columns=["isPartial"], errors="ignore")
+    # interest values are 0-100: float32 is exact and halves the frame
+    return df.astype(np.float32)
+
+# ----------------------------
+# Transform
+# ----------------------------
+def monthly(df, how="mean"):
+    """Month-end aggregate ("mean" or "last") grouped on integer (year, month) keys.
+
+    Like resample("M"), every month between the first and last observation gets a row
+    (NaN where it had no data), so positional shifts such as a 12-month YoY stay aligned.
+    """
+    g = df.groupby([df.index.year, df.index.month])
+    out = g.mean() if how == "mean" else g.last()
+    if out.empty:
+        return out
+    month_starts = pd.DatetimeIndex([pd.Timestamp(y, m, 1) for y, m in out.index], name=df.index.name)
+    out.index = month_starts + pd.offsets.MonthEnd(0)
+    # groupby only yields months that have observations: restore the gaps
+    months = pd.date_range(out.index[0], out.index[-1], freq=pd.offsets.MonthEnd(), name=df.index.name)
+    return out.reindex(months)
+
+# ----------------------------
+# Plot helpers
+# ----------------------------
+@lru_cache(maxsize=1)
+def pyplot():
+    """matplotlib.pyplot on the headless Agg backend, imported and configured on first use."""
+    import matplotlib
+    matplotlib.use("Agg")  # file output only, skip GUI backend probing
+    import matplotlib.pyplot as plt
+    # merge near-collinear segments when drawing the line paths
+    plt.rcParams["path.simplify_threshold"] = 1.0
+    return plt
+
+def add_line_collection(ax, index, values):
+    """Draw each column of ``values`` against the DatetimeIndex as one LineCollection.
+
+    All series go to Agg as a single artist; returns proxy handles for the legend.
+    """
+    from matplotlib import dates as mdates
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+    x = mdates.date2num(index)
+    y = values.T  # (n_lines, n_points)
+    segs = np.stack([np.broadcast_to(x, y.shape), y], axis=-1)  # (n_lines, n_points, 2)
+    cycle = pyplot().rcParams["axes.prop_cycle"].by_key()["color"]
+    colors = [cycle[i % len(cycle)] for i in range(len(segs))]
+    ax.add_collection(LineCollection(segs, colors=colors, rasterized=True))
+    ax.xaxis_date()
+    ax.autoscale()
+    return [Line2D([], [], color=c) for c in colors]
@@ -3,11 +3,18 @@
 # Fetch M2 (YoY%), HY spread, VIX from FRED and output CSV + PNG reliably.
 
 import os
+import sys
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from pandas_datareader import data as pdr
+import requests
+
+from market_watch_common import (
+    FRED_CACHE_MAX_AGE, PNG_PIL_KWARGS, backoff, fetch_fred_csv, fred_cache_path, is_transient,
+    monthly, pyplot, read_cache, write_cache,
+)
 
 # CONFIG
 FRED_M2 = "M2SL"
@@ -19,104 +26,129 @@ OUT_CSV = "macro_data.csv"
 OUT_PNG = "macro_graph.png"
 RAW_DIR = "debug_raw"
 os.makedirs(RAW_DIR, exist_ok=True)
+# The raw dumps double as the FRED cache (one file per series and date window):
+# re-runs within FRED_CACHE_MAX_AGE skip the network
+# (set MW_FORCE_REFRESH=1 to always re-download)
 
 # Date range: go back enough to compute YoY (use 24 months as safe)
 END = pd.Timestamp.today().normalize()
 START = END - pd.DateOffset(months=24)
 
-def fetch_fred(series_id, start=START, end=END, tries=3, pause=3):
-    last_err = None
+def fetch_fred(series_id, start=START, end=END, tries=3, pause=3, session=None):
+    raw_path = fred_cache_path(series_id, start, end, RAW_DIR)
+    cached = read_cache(raw_path, max_age=FRED_CACHE_MAX_AGE)
+    if cached is not None:
+        print(f"[FRED] {series_id} loaded from cache {raw_path}", flush=True)
+        return cached
+    df, last_err = None, None
     for i in range(tries):
         try:
             print(f"[FRED] fetching {series_id} (attempt {i+1})...", flush=True)
-            df = pdr.DataReader(series_id, "fred", start, end)
-            if df is None or df.empty:
-                print(f"[FRED] Warning: returned empty for {series_id}", flush=True)
-                return pd.DataFrame()
-            df.columns = [series_id]
-            # save raw
-            raw_path = os.path.join(RAW_DIR, f"{series_id}_raw.csv")
-            df.to_csv(raw_path)
-            print(f"[FRED] saved raw to {raw_path}", flush=True)
-            return df
+            df = fetch_fred_csv(series_id, start, end, session)
+            break
         except Exception as e:
             last_err = e
             print(f"[FRED] attempt {i+1} failed for {series_id}: {e}", flush=True)
-            time.sleep(pause)
-    raise RuntimeError(f"Failed to fetch {series_id} after {tries} attempts. Last error: {last_err}")
+            if not is_transient(e):
+                # 4xx / bad payload: another attempt would fail the same way
+                break
+            if i + 1 < tries:
+                time.sleep(backoff(i, base=pause))
+    if df is None:
+        raise RuntimeError(f"Failed to fetch {series_id} after {i+1} attempt(s). Last error: {last_err}")
+    if df.empty:
+        print(f"[FRED] Warning: returned empty for {series_id}", flush=True)
+        return pd.DataFrame()
+    # save raw (Parquet: binary columnar write, no per-cell string formatting)
+    if write_cache(df, raw_path):
+        print(f"[FRED] saved raw to {raw_path}", flush=True)
+    return df
 
-def compute_m2_yoy(m2_df, series_id=FRED_M2):
-    if m2_df is None or m2_df.empty:
+def compute_m2_yoy(m2_mon, series_id=FRED_M2):
+    if m2_mon is None or m2_mon.empty:
         return pd.DataFrame()
-    # resample to month-end using last observation
-    m2_mon = m2_df.resample("M").last()
-    m2_mon = m2_mon.sort_index()
-    # compute 12-month pct change
-    m2_mon["M2_YoY_pct"] = m2_mon[series_id].pct_change(periods=12) * 100.0
-    return m2_mon[["M2_YoY_pct"]]
-
-def hy_to_bps(hy_df, series_id=FRED_HY):
-    if hy_df is None or hy_df.empty:
+    # compute 12-month pct change: one vectorised division on the raw array
+    vals = m2_mon[series_id].to_numpy()
+    yoy = np.full_like(vals, np.nan)
+    yoy[12:] = (vals[12:] / vals[:-12] - 1.0) * 100.0
+    return pd.DataFrame({"M2_YoY_pct": yoy}, index=m2_mon.index)
+
+def hy_to_bps(hy_mon, series_id=FRED_HY):
+    if hy_mon is None or hy_mon.empty:
         return pd.DataFrame()
-    hy_mon = hy_df.resample("M").last()
-    hy_mon = hy_mon.sort_index()
+    arr = hy_mon[series_id].to_numpy()
     # check scale: if median < 20 treat as percent (e.g., 3.1 -> 310 bps)
-    med = hy_mon[series_id].median()
-    if pd.notna(med) and abs(med) < 20:
-        hy_mon["HY_spread_bps"] = hy_mon[series_id] * 100.0
+    med = np.nanmedian(arr) if np.isfinite(arr).any() else np.nan
+    if np.isfinite(med) and abs(med) < 20:
+        out = arr * 100.0
         print(f"[HY] median {med:.3f} <20 -> converted to bps by *100", flush=True)
     else:
-        hy_mon["HY_spread_bps"] = hy_mon[series_id]
+        out = arr
         print(f"[HY] median {med:.3f} -> assumed already in bps or large units", flush=True)
-    return hy_mon[["HY_spread_bps"]]
+    return pd.DataFrame({"HY_spread_bps": out}, index=hy_mon.index)
 
-def vix_monthly(vix_df, series_id=FRED_VIX):
-    if vix_df is None or vix_df.empty:
+def vix_monthly(vix_mon, series_id=FRED_VIX):
+    if vix_mon is None or vix_mon.empty:
         return pd.DataFrame()
-    vix_mon = vix_df.resample("M").last()
-    vix_mon = vix_mon.sort_index()
-    vix_mon.columns = ["VIX"]
-    return vix_mon[["VIX"]]
+    return vix_mon[[series_id]].rename(columns={series_id: "VIX"})
+
+# FRED series -> helper turning its month-end column into the output column(s)
+MONTHLY_TRANSFORMS = {
+    FRED_M2: compute_m2_yoy,
+    FRED_HY: hy_to_bps,
+    FRED_VIX: vix_monthly,
+}
 
 def main():
     print("Start macro fetch", flush=True)
-    m2_raw = fetch_fred(FRED_M2)
-    hy_raw = fetch_fred(FRED_HY)
-    vix_raw = fetch_fred(FRED_VIX)
-
-    m2_yoy = compute_m2_yoy(m2_raw, FRED_M2)
-    hy_bps = hy_to_bps(hy_raw, FRED_HY)
-    vix_mon = vix_monthly(vix_raw, FRED_VIX)
-
-    # Combine on month-end index
-    dfs = [d for d in [m2_yoy, hy_bps, vix_mon] if not d.empty]
-    if not dfs:
+    # the three series are independent network calls -> fetch concurrently, sharing one
+    # Session built here before any job starts (each concurrent GET uses its own pooled connection)
+    raw = {}
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=3) as pool:
+        futures = {sid: pool.submit(fetch_fred, sid, session=session) for sid in MONTHLY_TRANSFORMS}
+        for sid, fut in futures.items():
+            try:
+                raw[sid] = fut.result()
+            except Exception as e:
+                print(f"[FRED] {e}", flush=True)
+                raw[sid] = pd.DataFrame()
+
+    frames = [df for df in raw.values() if not df.empty]
+    if not frames:
         print("No data available from FRED. Exiting.", flush=True)
         # create placeholder CSV
         pd.DataFrame().to_csv(OUT_CSV)
         return 1
 
-    combined = pd.concat(dfs, axis=1)
-    combined = combined.sort_index().ffill().bfill()
-    # Force DATE column as ISO string of index (month end)
-    out = combined.copy()
-    out.insert(0, "DATE", out.index.strftime("%Y-%m-%d"))
-    out.to_csv(OUT_CSV, index=False, float_format="%.6f")
+    # outer-join the raw observations first, then one month-end aggregation for every series
+    daily = reduce(lambda a, b: a.join(b, how="outer"), frames)
+    mon = monthly(daily, "last")
+
+    # month-end series -> output column(s), all on the shared month-end index
+    dfs = [to_output(mon[[sid]], sid) for sid, to_output in MONTHLY_TRANSFORMS.items() if sid in mon.columns]
+    # every output already sits on mon.index (ascending month ends), so place the columns on
+    # that one grid directly instead of joining them pairwise; then one ffill pass.
+    # forward-fill only: bfill would copy later observations back into earlier months
+    combined = pd.DataFrame({col: out[col].reindex(mon.index) for out in dfs for col in out.columns})
+    combined = combined.ffill()
+    # DATE column = month-end index as ISO date, written by to_csv itself (no copy)
+    combined.to_csv(OUT_CSV, index=True, index_label="DATE", date_format="%Y-%m-%d", float_format="%.6f", lineterminator="\n")
     print(f"Saved {OUT_CSV}", flush=True)
 
     # Plot: left = M2 YoY and HY_spread_bps; right = VIX
+    plt = pyplot()
     fig, axL = plt.subplots(figsize=(12,6))
     if "M2_YoY_pct" in combined.columns:
-        axL.plot(combined.index, combined["M2_YoY_pct"], label="M2 YoY (%)", color="tab:blue", linewidth=2)
+        axL.plot(combined.index, combined["M2_YoY_pct"], label="M2 YoY (%)", color="tab:blue", linewidth=2, rasterized=True)
     if "HY_spread_bps" in combined.columns:
-        axL.plot(combined.index, combined["HY_spread_bps"], label="HY Spread (bps)", color="tab:red", linewidth=1.5)
+        axL.plot(combined.index, combined["HY_spread_bps"], label="HY Spread (bps)", color="tab:red", linewidth=1.5, rasterized=True)
     axL.set_xlabel("Date")
     axL.set_ylabel("Left axis: M2 YoY (%) / HY Spread (bps)")
     axL.grid(True, linestyle="--", alpha=0.4)
 
     axR = axL.twinx()
     if "VIX" in combined.columns:
-        axR.plot(combined.index, combined["VIX"], label="VIX", color="tab:orange", linestyle="--")
+        axR.plot(combined.index, combined["VIX"], label="VIX", color="tab:orange", linestyle="--", rasterized=True)
         axR.set_ylabel("VIX")
 
     # legend
@@ -124,12 +156,13 @@ def main():
     linesR, labelsR = axR.get_legend_handles_labels()
     axL.legend(linesL + linesR, labelsL + labelsR, loc="upper left")
 
-    plt.title("M2 YoY (%) & HY Spread (bps) / VIX")
-    plt.tight_layout()
-    plt.savefig(OUT_PNG, dpi=150)
-    plt.close()
+    axL.set_title("M2 YoY (%) & HY Spread (bps) / VIX")
+    fig.tight_layout()
+    fig.savefig(OUT_PNG, dpi=150, pil_kwargs=PNG_PIL_KWARGS)
+    # release every figure buffer before interpreter teardown
+    plt.close("all")
     print(f"Saved {OUT_PNG}", flush=True)
     return 0
 
 if __name__ == "__main__":
-    exit(main())
+    sys.exit(main())
@@ -1,12 +1,19 @@
 # market_watch_trends.py
 # Replace the file entirely with this content.
 
+import argparse
+import hashlib
+import os
+import shutil
 import time
 import sys
 import traceback
 import pandas as pd
-import matplotlib.pyplot as plt
-from pytrends.request import TrendReq
+
+from market_watch_common import (
+    CACHE_DIR, PNG_PIL_KWARGS, TRENDS_CACHE_MAX_AGE, add_line_collection, backoff, fetch_interest,
+    is_transient, pyplot, pytrends_client, read_cache, trends_cache_path, write_cache,
+)
 
 # ---- 設定（ここをそのまま使います） ----
 KEYWORDS = [
@@ -24,75 +31,157 @@ USER_AGENT = (
     "Chrome/114.0.0.0 Safari/537.36"
 )
 
+# 試すtimeframes（空なら長い期間, それでもダメなら日次を短く）
+TIMEFRAMES = ["today 6-m", "today 12-m", "today 3-m", "now 7-d"]
+
 OUT_CSV = "trends_data.csv"
 OUT_PNG = "trends_graph.png"
+# "no data" placeholder image (part of its cache key, so changing these re-renders it)
+PLACEHOLDER_FIGSIZE = (8, 4)
+PLACEHOLDER_FONTSIZE = 20
+
+# Circuit breaker, counted over the whole run: the first 429 gets one Retry-After wait and a
+# single probe on the next timeframe; the next 429 stops querying Google for the rest of the run
+TRENDS_MAX_429 = 2
+TRENDS_RETRY_AFTER = 60      # seconds to wait when the 429 carries no usable Retry-After header
+TRENDS_RETRY_AFTER_CAP = 90  # never wait longer than this, whatever the header says
+_trends_429s = 0
+
+class CircuitOpen(RuntimeError):
+    """Raised once Google has rate-limited this run often enough that further queries are skipped."""
+
+def _retry_after(exc):
+    """Seconds a 429 asks us to wait (numeric Retry-After header), capped; a default otherwise."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        seconds = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        seconds = TRENDS_RETRY_AFTER
+    return min(max(seconds, 0.0), TRENDS_RETRY_AFTER_CAP)
+
+def _retry_delay(exc, attempt):
+    """Seconds to wait before the next timeframe: Retry-After for a 429, full-jitter back-off otherwise."""
+    from pytrends.exceptions import TooManyRequestsError
+    if isinstance(exc, TooManyRequestsError):
+        return _retry_after(exc)
+    return backoff(attempt, base=2.0)
 
 def fetch_trends(keywords, timeframes):
     """複数のtimeframeを試して、空でないデータを返す。失敗時はNoneを返す。"""
-    pytrends = TrendReq(hl="en-US", tz=360, requests_args={"headers": {"User-Agent": USER_AGENT}})
-    for tf in timeframes:
+    global _trends_429s
+    for attempt, tf in enumerate(timeframes):
+        cache_path = trends_cache_path(keywords, tf)
+        cached = read_cache(cache_path, max_age=TRENDS_CACHE_MAX_AGE)
+        if cached is not None:
+            print(f"Loaded timeframe {tf} from cache {cache_path}", flush=True)
+            return cached
+        if _trends_429s >= TRENDS_MAX_429:
+            raise CircuitOpen(f"{_trends_429s} 429s from Google Trends this run; not querying {tf}")
         try:
             print(f"Trying timeframe: {tf}", flush=True)
-            pytrends.build_payload(keywords, timeframe=tf)
-            df = pytrends.interest_over_time()
-            if df is None or df.empty:
+            df = fetch_interest(pytrends_client(USER_AGENT), keywords, tf)
+            if df.empty:
                 print(" -> empty result", flush=True)
                 continue
-            # drop isPartial column if present
-            if "isPartial" in df.columns:
-                df = df.drop(columns=["isPartial"])
-            return df
         except Exception as e:
             print(f"Exception while fetching timeframe {tf}: {e}", flush=True)
             traceback.print_exc()
-            time.sleep(2)
+            from pytrends.exceptions import TooManyRequestsError
+            if isinstance(e, TooManyRequestsError):
+                _trends_429s += 1
+            # the next timeframe is a different request, so always fall through to it; only
+            # transient errors (429 / 5xx / network) are worth a back-off first, and once the
+            # breaker is open there is nothing to wait for (only cache lookups remain)
+            if (is_transient(e) and attempt + 1 < len(timeframes)
+                    and _trends_429s < TRENDS_MAX_429):
+                time.sleep(_retry_delay(e, attempt))
+            continue
+        write_cache(df, cache_path)
+        return df
     return None
 
 def save_csv(df, path):
-    df.to_csv(path, index=True)
+    df.to_csv(path, index=True, float_format="%g", lineterminator="\n")
     print(f"Saved CSV: {path} (rows={len(df)})", flush=True)
 
 def plot_trends(df, keywords, out_png):
-    plt.figure(figsize=(12,5))
-    for kw in keywords:
-        if kw in df.columns:
-            plt.plot(df.index, df[kw], label=kw)
-    plt.title("Google Trends (daily) - specified keywords")
-    plt.xlabel("Date")
-    plt.ylabel("Interest (0-100)")
-    plt.legend(loc="upper right")
-    plt.tight_layout()
-    plt.savefig(out_png)
-    plt.close()
+    plt = pyplot()
+    fig, ax = plt.subplots(figsize=(12,5))
+    present = df.columns.intersection(keywords, sort=False).tolist()
+    handles = add_line_collection(ax, df.index, df[present].to_numpy())
+    ax.set_title("Google Trends (daily) - specified keywords")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Interest (0-100)")
+    ax.legend(handles, present, loc="upper right")
+    fig.tight_layout()
+    fig.savefig(out_png, pil_kwargs=PNG_PIL_KWARGS)
+    plt.close(fig)
     print(f"Saved PNG: {out_png}", flush=True)
 
+def _render_placeholder_png(target, message):
+    """Draw ``message`` centred on a blank PLACEHOLDER_FIGSIZE image saved to ``target``."""
+    # bare Figure on an Agg canvas: no pyplot state to manage or close
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=PLACEHOLDER_FIGSIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.text(0.5, 0.5, message, ha='center', va='center', fontsize=PLACEHOLDER_FONTSIZE)
+    ax.axis('off')
+    fig.tight_layout()
+    fig.savefig(target, pil_kwargs=PNG_PIL_KWARGS)
+
 def make_empty_placeholder_png(path, message="No trends data"):
-    plt.figure(figsize=(8,4))
-    plt.text(0.5, 0.5, message, ha='center', va='center', fontsize=20)
-    plt.axis('off')
-    plt.tight_layout()
-    plt.savefig(path)
-    plt.close()
+    # rendered once per message + rendering parameters, later runs copy the cached image;
+    # the cache is an optimisation only, the placeholder itself is always written
+    import matplotlib
+    key = (message, PLACEHOLDER_FIGSIZE, PLACEHOLDER_FONTSIZE, PNG_PIL_KWARGS, matplotlib.__version__)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    cached = os.path.join(CACHE_DIR, "placeholder", f"{digest}.png")
+    try:
+        shutil.copyfile(cached, path)
+        print(f"Saved placeholder PNG: {path} (cached)", flush=True)
+        return
+    except OSError:
+        pass
+    _render_placeholder_png(path, message)
     print(f"Saved placeholder PNG: {path}", flush=True)
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, cached)  # atomic: a concurrent reader never sees a partial PNG
+    except OSError as e:
+        print(f"⚠️ could not cache placeholder {cached}: {e}", flush=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch Google Trends for KEYWORDS and save CSV/PNG.")
+    parser.add_argument("--out-csv", default=OUT_CSV)
+    parser.add_argument("--out-png", default=OUT_PNG)
+    parser.add_argument("--timeframe", dest="timeframes", action="append",
+                        help="pytrends timeframe to try (repeatable, in order); default: %s" % TIMEFRAMES)
+    return parser.parse_args(argv)
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     # pytrends supports up to 5 keywords in one payload (we use exactly 5)
-    # 試すtimeframes（空なら長い期間, それでもダメなら日次を短く）
-    timeframes = ["today 6-m", "today 12-m", "today 3-m", "now 7-d"]
-    df = fetch_trends(KEYWORDS, timeframes)
+    try:
+        df = fetch_trends(KEYWORDS, args.timeframes or TIMEFRAMES)
+    except CircuitOpen as e:
+        print(f"⚠️ {e}", flush=True)
+        df = None
 
     if df is None or df.empty:
         print("⚠️ No trends data fetched for any timeframe. Writing placeholder outputs.", flush=True)
         # 空CSV作成（ヘッダのみ）
         empty_df = pd.DataFrame(columns=KEYWORDS)
-        empty_df.to_csv(OUT_CSV, index=True)
-        make_empty_placeholder_png(OUT_PNG, "No trends data")
-        sys.exit(0)  # 成功終了（ワークフローは続行させたい場合）
-    else:
-        # 日次 -> 季月平均など必要ならここで変換可能（今はそのまま保存）
-        save_csv(df, OUT_CSV)
-        plot_trends(df, KEYWORDS, OUT_PNG)
-        sys.exit(0)
+        empty_df.to_csv(args.out_csv, index=True)
+        make_empty_placeholder_png(args.out_png, "No trends data")
+        return 0  # 成功終了（ワークフローは続行させたい場合）
+    # 日次 -> 季月平均など必要ならここで変換可能（今はそのまま保存）
+    save_csv(df, args.out_csv)
+    plot_trends(df, KEYWORDS, args.out_png)
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())